@@ -1,40 +1,296 @@
+from collections import OrderedDict
+import math
 from functools import partial
 import os
-import random
+import numba
+import numpy as np
 import torchaudio
 import torch
-from torch.utils.data import Dataset, DataLoader, Subset
-from typing import Dict, List, Tuple, Any, Union
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, Subset, Sampler
+from typing import Dict, List, Tuple, Any, Union, Optional, Iterator
 from glob import glob
 import librosa
 import librosa.display
 import matplotlib.pyplot as plt
-from settings import FS
+from settings import FS, cache_size_mb
 
 
 Tensor = torch.Tensor
 
 
-def read_wav_at_FS(filename: str) -> Tensor:
+# one resampler per (source fs, device), so that the filter kernel is only built once
+_resamplers: Dict[Tuple[int, str], torchaudio.transforms.Resample] = {}
+
+
+def get_resampler(fs: int, device: torch.device) -> torchaudio.transforms.Resample:
+    key = (fs, str(device))
+    if key not in _resamplers:
+        _resamplers[key] = torchaudio.transforms.Resample(fs, FS).to(device)
+    return _resamplers[key]
+
+
+def read_wav_at_FS(filename: str, device: torch.device = torch.device("cpu")) -> Tensor:
+    """
+    Returns 1 x T mono wav at FS on cpu. `device` is where resampling happens.
+    Only use cuda from the main process, e.g. in `build_cache`, as DataLoader workers are forked.
+    """
     y, fs = torchaudio.load(filename)
+    return monoize_n_resample(y, fs, device)
+
+
+def monoize_n_resample(
+    y: Tensor, fs: int, device: torch.device = torch.device("cpu")
+) -> Tensor:
     # if y.shape[0] != 2:
     #     y = y.repeat(2, 1)
-    if y.shape[0] > 1:
+    if y.shape[0] == 2:
+        # common case, avoids the reduction kernel of mean
+        y = y[0].add(y[1]).mul_(0.5).unsqueeze(0)
+    elif y.shape[0] > 2:
         y = y.mean(dim=0, keepdim=True)
     if fs != FS:
-        y = torchaudio.functional.resample(y, fs, FS)
+        y = get_resampler(fs, device)(y.to(device)).cpu()
     return y
 
 
+def read_wav_segment_at_FS(filename: str, fs: int, start: int, length: int) -> Tensor:
+    """
+    Returns 1 x (at most) length mono wav at FS, starting at sample `start` (at FS),
+    without decoding the whole file. `fs` is the sample rate of the file.
+    The result is shorter than `length` if the file ends before `start + length`.
+    """
+    frame_offset = start * fs // FS
+    num_frames = -(-length * fs // FS)  # ceil
+    y, _ = torchaudio.load(filename, frame_offset=frame_offset, num_frames=num_frames)
+    return monoize_n_resample(y, fs)[:, :length]
+
+
+def tensor_nbytes(t: Tensor) -> int:
+    return t.numel() * t.element_size()
+
+
 class CachedLoader:
-    def __init__(self) -> None:
-        self.map: Dict[str, Tensor] = {}
+    """
+    LRU cache of decoded wavs, bounded by `capacity_mb` (defaults to $TSE_CACHE_MB).
+    Wavs are stored as float16 to halve the footprint, cast them back with `.float()` before use.
+    Note that every DataLoader worker holds its own copy of the cache.
+    """
+
+    def __init__(self, capacity_mb: int = cache_size_mb) -> None:
+        self.map: OrderedDict[str, Tensor] = OrderedDict()
+        self.capacity = capacity_mb * 1024 * 1024
+        self.nbytes = 0
+        self.lengths: Dict[str, int] = {}
+        self.sample_rates: Dict[str, int] = {}
+
+    def __getitem__(self, key: str) -> Tensor:
+        if key in self.map:
+            self.map.move_to_end(key)
+            return self.map[key]
+
+        wav = read_wav_at_FS(key).half()
+        size = tensor_nbytes(wav)
+        while self.map and self.nbytes + size > self.capacity:
+            _, evicted = self.map.popitem(last=False)
+            self.nbytes -= tensor_nbytes(evicted)
+        self.map[key] = wav
+        self.nbytes += size
+
+        return wav
+
+    def warm_up(self, keys: List[str]) -> None:
+        """
+        Load `keys` into shared memory. Call this in the main process before DataLoader forks its workers,
+        so that all workers read the same cached tensors instead of decoding them again.
+        Stops once the cache is full, as further files would evict the ones just warmed.
+        Shared tensors live in /dev/shm, which is only 64MB by default in docker (see `--shm-size`).
+        """
+        for key in keys:
+            # 2 bytes per float16 sample
+            if self.nbytes + self.get_length(key) * 2 > self.capacity:
+                break
+            self[key].share_memory_()
+
+    def set_length(
+        self, key: str, length: int, sample_rate: Optional[int] = None
+    ) -> None:
+        # e.g. from a manifest, so that the header doesn't have to be read again
+        self.lengths[key] = length
+        if sample_rate is not None:
+            self.sample_rates[key] = sample_rate
+
+    def get_length(self, key: str) -> int:
+        """
+        Number of samples at FS, read from the header. For compressed formats (m4a, mp3) the header
+        is only an estimate: 0 means unknown, so we decode the file, otherwise it is treated as an upper bound
+        and corrected by `get_segment` on a short read.
+        """
+        if key not in self.lengths:
+            info = torchaudio.info(key)
+            self.sample_rates[key] = info.sample_rate
+            if info.num_frames > 0:
+                self.lengths[key] = info.num_frames * FS // info.sample_rate
+            else:
+                self.lengths[key] = read_wav_at_FS(key).shape[-1]
+        return self.lengths[key]
+
+    def get_segment(self, key: str, start: int, length: int) -> Tensor:
+        if self.get_length(key) < length:
+            # the whole file is needed and is short, so keep it in the cache
+            wav = self[key].float()
+            self.lengths[key] = wav.shape[-1]
+            return F.pad(wav, (0, length - wav.shape[-1]))
+
+        # segments bypass the cache, so long dirty files are never fully decoded
+        if key not in self.sample_rates:
+            self.sample_rates[key] = torchaudio.info(key).sample_rate
+        segment = read_wav_segment_at_FS(key, self.sample_rates[key], start, length)
+        if segment.shape[-1] == length:
+            return segment
+
+        # the header overestimated the length, decode the whole file once to get the real one
+        wav = read_wav_at_FS(key)
+        self.lengths[key] = wav.shape[-1]
+        start = max(0, min(start, wav.shape[-1] - length))
+        segment = wav[:, start : start + length]
+        # only pads if the whole file is shorter than `length`
+        return F.pad(segment, (0, length - segment.shape[-1]))
+
+
+def list_files(
+    clean_folder: str, dirty_folders: List[str]
+) -> Tuple[List[str], List[str]]:
+    clean_files = [f for f in glob(os.path.join(clean_folder, "*.wav"))]
+    dirty_files = [
+        f
+        for d in dirty_folders
+        for f in glob(os.path.join(d, "*.wav"))
+        + glob(os.path.join(d, "*.m4a"))
+        + glob(os.path.join(d, "*.mp3"))
+    ]
+    return clean_files, dirty_files
+
+
+def build_manifest(
+    clean_folder: str, dirty_folders: List[str], manifest_path: str
+) -> None:
+    """
+    Scan the folders once and save the file lists, their lengths at FS and the sample rates of dirty files,
+    see `MixedAudioDataset.from_manifest`.
+    """
+    clean_files, dirty_files = list_files(clean_folder, dirty_folders)
+    loader = CachedLoader()
+    np.savez(
+        manifest_path,
+        clean_files=np.array(clean_files, dtype=str),
+        dirty_files=np.array(dirty_files, dtype=str),
+        clean_lens=np.array(
+            [loader.get_length(f) for f in clean_files], dtype=np.int64
+        ),
+        dirty_lens=np.array(
+            [loader.get_length(f) for f in dirty_files], dtype=np.int64
+        ),
+        dirty_sample_rates=np.array(
+            [loader.sample_rates[f] for f in dirty_files], dtype=np.int64
+        ),
+    )
+
+
+def get_cache_index_path(cache_path: str) -> str:
+    return cache_path + ".index.npy"
+
+
+def build_cache(clean_folder: str, dirty_folders: List[str], cache_path: str) -> None:
+    """
+    Decode every clean and dirty file once at FS, and store them concatenated as float16 in `cache_path`.
+    An index with (path, offset, length) for each file is written to `cache_path + ".index.npy"`.
+    """
+    clean_files, dirty_files = list_files(clean_folder, dirty_folders)
+    files = clean_files + dirty_files
+    offsets = np.zeros(len(files), dtype=np.int64)
+    lengths = np.zeros(len(files), dtype=np.int64)
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    offset = 0
+    with open(cache_path, "wb") as f:
+        for i, filename in enumerate(files):
+            y = read_wav_at_FS(filename, device)[0].numpy().astype(np.float16)
+            f.write(y.tobytes())
+            offsets[i] = offset
+            lengths[i] = y.shape[-1]
+            offset += y.shape[-1]
+
+    index = np.zeros(
+        len(files),
+        dtype=[
+            ("path", "U%d" % max(map(len, files), default=1)),
+            ("offset", np.int64),
+            ("length", np.int64),
+        ],
+    )
+    index["path"] = files
+    index["offset"] = offsets
+    index["length"] = lengths
+    np.save(get_cache_index_path(cache_path), index)
+
+
+class MemmapLoader:
+    """
+    Read-only view of a cache built by `build_cache`.
+    The memmap is shared by forked DataLoader workers through the OS page cache.
+    """
+
+    def __init__(self, cache_path: str) -> None:
+        self.mm = np.memmap(cache_path, dtype=np.float16, mode="r")
+        index = np.load(get_cache_index_path(cache_path))
+        self.indices: Dict[str, int] = {
+            path: i for i, path in enumerate(index["path"].tolist())
+        }
+        self.starts: np.ndarray = index["offset"]
+        self.lengths: np.ndarray = index["length"]
 
     def __getitem__(self, key: str) -> Tensor:
-        if key not in self.map:
-            self.map[key] = read_wav_at_FS(key)
+        return self.get_segment(key, 0, self.get_length(key))
+
+    def get_length(self, key: str) -> int:
+        return int(self.lengths[self.indices[key]])
 
-        return self.map[key]
+    def get_segment(self, key: str, start: int, length: int) -> Tensor:
+        i = self.indices[key]
+        # never read past the end of this file into the next one
+        end = self.starts[i] + min(start + length, self.lengths[i])
+        start += self.starts[i]
+        wav = np.asarray(self.mm[start:end], dtype=np.float32)
+        # only pads if the whole file is shorter than `length`
+        return F.pad(torch.from_numpy(wav).unsqueeze(0), (0, length - wav.shape[-1]))
+
+
+@numba.njit(cache=True, fastmath=True)
+def mix_kernel(clean: np.ndarray, dirty: np.ndarray, dirty_weight: float) -> np.ndarray:
+    """
+    Same as `clean + dirty_weight * MixedAudioDataset.get_max_mul(clean, dirty) * dirty`,
+    in two fused passes over 1D arrays.
+    """
+    # no inf sentinel, fastmath assumes there are no infs.
+    # a silent dirty segment gives max_w = 0 instead of inf, which would turn into nan.
+    max_w = 0.0
+    found = False
+    for i in range(clean.size):
+        d = dirty[i]
+        if d != 0.0:
+            w = (1.0 - clean[i] * math.copysign(1.0, d)) / abs(d)
+            if not found or w < max_w:
+                max_w = w
+                found = True
+
+    # |c| > 1 (e.g. resampling overshoot) makes the bound negative, don't flip the dirty sign
+    max_w = max(0.0, max_w)
+
+    res = np.empty_like(clean)
+    for i in range(clean.size):
+        res[i] = clean[i] + dirty_weight * max_w * dirty[i]
+    return res
 
 
 MixedAudioDatasetOutput = Tuple[Tensor, Tensor]
@@ -43,7 +299,10 @@ MixedAudioDatasetOutput = Tuple[Tensor, Tensor]
 class MixedAudioDataset(Dataset):
     """
     Accept clean folder and dirty folders.
-    Each time when asked to fetch something, we load, monoize, resample, and cache each file.
+    Each time when asked to fetch something, we load, monoize and resample the files.
+    Clean files are kept as float16 in an LRU cache bounded by $TSE_CACHE_MB (see `CachedLoader`).
+    Dirty files are read by segment and not cached, unless they are shorter than the clean wav.
+    If `cache_path` is given, files are read from a cache built by `build_cache` instead.
     Mixed files are generated by following procedure:
     0. randomly select a clean wav from files in all clean files
     1. randomly select a dirty wav from files in all dirty files
@@ -53,20 +312,78 @@ class MixedAudioDataset(Dataset):
     5. returns mixed and clean wav
     """
 
-    def __init__(self, clean_folder: str, dirty_folders: List[str]):
-        self.clean_files = [f for f in glob(os.path.join(clean_folder, "*.wav"))]
-        self.dirty_files = [
-            f
-            for d in dirty_folders
-            for f in glob(os.path.join(d, "*.wav"))
-            + glob(os.path.join(d, "*.m4a"))
-            + glob(os.path.join(d, "*.mp3"))
-        ]
-        self.cached_loader = CachedLoader()
+    def __init__(
+        self,
+        clean_folder: str,
+        dirty_folders: List[str],
+        cache_path: Optional[str] = None,
+    ):
+        clean_files, dirty_files = list_files(clean_folder, dirty_folders)
+        self._init_files(clean_files, dirty_files, self.get_loader(cache_path))
+
+    @classmethod
+    def from_manifest(
+        cls, manifest_path: str, cache_path: Optional[str] = None
+    ) -> "MixedAudioDataset":
+        """
+        Build the dataset from a manifest saved by `build_manifest`, without scanning the folders.
+        """
+        manifest = np.load(manifest_path)
+        clean_files = manifest["clean_files"].tolist()
+        dirty_files = manifest["dirty_files"].tolist()
+
+        cached_loader = cls.get_loader(cache_path)
+        if isinstance(cached_loader, CachedLoader):
+            # the memmap index already has exact lengths
+            for f, length in zip(clean_files, manifest["clean_lens"].tolist()):
+                cached_loader.set_length(f, length)
+            for f, length, sample_rate in zip(
+                dirty_files,
+                manifest["dirty_lens"].tolist(),
+                manifest["dirty_sample_rates"].tolist(),
+            ):
+                cached_loader.set_length(f, length, sample_rate)
+
+        dataset = cls.__new__(cls)
+        dataset._init_files(clean_files, dirty_files, cached_loader)
+        return dataset
+
+    @staticmethod
+    def get_loader(cache_path: Optional[str]) -> Union[CachedLoader, MemmapLoader]:
+        return CachedLoader() if cache_path is None else MemmapLoader(cache_path)
+
+    def _init_files(
+        self,
+        clean_files: List[str],
+        dirty_files: List[str],
+        cached_loader: Union[CachedLoader, MemmapLoader],
+    ) -> None:
+        self.clean_files = clean_files
+        self.dirty_files = dirty_files
+        self.cached_loader = cached_loader
+        # read the lengths once in the main process, so that forked workers don't have to
+        for f in self.dirty_files:
+            self.cached_loader.get_length(f)
+        # seeded from torch so that `seed_everything` / `torch.manual_seed` cover it,
+        # and reseeded in each DataLoader worker by `worker_init_fn`
+        self.rng = np.random.default_rng(torch.randint(2**63 - 1, ()).item())
 
     def __len__(self):
         return len(self.clean_files)
 
+    def get_clean_lens(self) -> List[int]:
+        # free with a manifest or the memmap cache, otherwise reads every clean file's header
+        return [self.cached_loader.get_length(f) for f in self.clean_files]
+
+    def warm_cache(self, fraction: float) -> None:
+        """
+        Preload `fraction` of clean files into the cache before DataLoader workers are forked.
+        Dirty files are read by segments and never cached. No-op with `cache_path`, the memmap is already shared.
+        """
+        if isinstance(self.cached_loader, CachedLoader):
+            n = int(len(self.clean_files) * fraction)
+            self.cached_loader.warm_up(self.clean_files[:n])
+
     @staticmethod
     def get_max_mul(clean: Tensor, dirty: Tensor) -> float:
         # res = c + w * d, we want res in [-1, 1], so w * d in [-1 - c, 1 - c] and thus w in [(-1 - c) / d, (1 - c) / d]?
@@ -76,44 +393,42 @@ class MixedAudioDataset(Dataset):
             clean.size() == dirty.size()
         ), "Clean and dirty tensors must be of the same size"
 
-        # Mask for positive and negative dirty samples
-        positive_mask = dirty > 0
-        negative_mask = dirty < 0
+        # w >= 0, so for d > 0 we need w <= (1 - c) / d, and for d < 0 we need w <= (1 + c) / -d,
+        # i.e. w <= (1 - c * sign(d)) / |d|. Samples with d == 0 put no constraint on w.
+        bound = (1 - clean * torch.sign(dirty)) / dirty.abs().clamp_min(1e-12)
+        max_w = torch.where(dirty != 0, bound, torch.full_like(bound, float("inf")))
+        max_w = max_w.min().item()
 
-        # Calculate lower and upper bounds
-        lowerbound = (-1 - clean) / dirty
-        upperbound = (1 - clean) / dirty
+        if max_w == float("inf"):  # silent dirty segment, inf * 0 would give nan
+            return 0.0
+        # |c| > 1 (e.g. resampling overshoot) makes the bound negative, don't flip the dirty sign
+        return max(0.0, max_w)
 
-        # Initialize max_w with a large number
-        max_w = float("inf")
-
-        # Update max_w using the appropriate bounds depending on the sign of dirty samples
-        if positive_mask.any():
-            max_w = min(
-                max_w,
-                lowerbound[positive_mask].abs().min().item(),
-                upperbound[positive_mask].abs().min().item(),
-            )
-        if negative_mask.any():
-            max_w = min(
-                max_w,
-                lowerbound[negative_mask].abs().min().item(),
-                upperbound[negative_mask].abs().min().item(),
-            )
+    def get_dirty_segment(self, length: int) -> Tensor:
+        dirty_file = self.dirty_files[self.rng.integers(len(self.dirty_files))]
+        dirty_len = self.cached_loader.get_length(dirty_file)
 
-        return max_w
+        # Randomly select a start point for the dirty audio segment
+        start_point = int(self.rng.integers(max(0, dirty_len - length), endpoint=True))
+        return self.cached_loader.get_segment(dirty_file, start_point, length)
 
-    @staticmethod
-    def overlap_dirty_segment(clean_audio: Tensor, dirty_audio: Tensor) -> Tensor:
-        len_clean = clean_audio.shape[-1]
-        len_dirty = dirty_audio.shape[-1]
+    def overlap_dirty_segment(
+        self, clean_audio: Tensor, dirty_segment: Tensor
+    ) -> Tensor:
+        assert (
+            clean_audio.size() == dirty_segment.size()
+        ), "Clean and dirty tensors must be of the same size"
 
-        # Randomly select a start point for the dirty audio segment
-        start_point = random.randint(0, len_dirty - len_clean)
-        dirty_segment = dirty_audio[:, start_point : start_point + len_clean]
+        dirty_weight = 1 - self.rng.random() ** 2
+        if not clean_audio.is_cuda:
+            overlapped_audio = mix_kernel(
+                np.ascontiguousarray(clean_audio[0].numpy()),
+                np.ascontiguousarray(dirty_segment[0].numpy()),
+                dirty_weight,
+            )
+            return torch.from_numpy(overlapped_audio).unsqueeze(0)
 
-        max_mul = MixedAudioDataset.get_max_mul(clean_audio, dirty_segment)
-        dirty_weight = 1 - random.random() ** 2
+        max_mul = self.get_max_mul(clean_audio, dirty_segment)
         overlapped_audio = clean_audio + dirty_weight * max_mul * dirty_segment
 
         return overlapped_audio
@@ -124,12 +439,10 @@ class MixedAudioDataset(Dataset):
         if offset == 0:
             return wav
         wav_len = wav.shape[-1]
-        res = torch.zeros_like(wav)
+        # pad then crop, so the length is kept for any offset, even |offset| > wav_len
         if offset < 0:
-            res[..., : wav_len + offset] = wav[..., -offset:]
-        else:
-            res[..., offset:] = wav[..., : wav_len - offset]
-        return res
+            return F.pad(wav, (0, -offset))[..., -wav_len:]
+        return F.pad(wav, (offset, 0))[..., :wav_len]
 
     def __getitem__(self, idx: int) -> MixedAudioDatasetOutput:
         """
@@ -142,14 +455,13 @@ class MixedAudioDataset(Dataset):
             )
         """
         clean_file = self.clean_files[idx]
-        clean_wav = self.cached_loader[clean_file]
+        clean_wav = self.cached_loader[clean_file].float()
 
         clean_wav_len = clean_wav.shape[-1]
 
-        dirty_file = random.choice(self.dirty_files)
-        dirty_wav = self.cached_loader[dirty_file]
+        dirty_segment = self.get_dirty_segment(clean_wav_len)
 
-        mixed_wav = self.overlap_dirty_segment(clean_wav, dirty_wav)
+        mixed_wav = self.overlap_dirty_segment(clean_wav, dirty_segment)
 
         return mixed_wav, clean_wav
 
@@ -183,19 +495,66 @@ class N2NMixedAudioDataset(Dataset):
         return corrupted_x, corrupted_y
 
 
-def pad_seq_n_stack(wavs: List[Tensor], target_len: int) -> Tensor:
+def get_lengths(
+    dataset: Union[MixedAudioDataset, N2NMixedAudioDataset, Subset]
+) -> List[int]:
     """
-    Args:
-        wavs: list of 1 x T Tensor, T may vary.
-        target_len: assert to be max T in that varying 1 x T tensor list.
-    Returns:
-        result: B x target_len Tensor
+    Length of the wav returned for each index of `dataset`, without loading it.
+    """
+    if isinstance(dataset, MixedAudioDataset):
+        return dataset.get_clean_lens()
+    if isinstance(dataset, Subset):
+        lens = get_lengths(dataset.dataset)
+        return [lens[i] for i in dataset.indices]
+    return get_lengths(dataset.dataset)
+
+
+class BucketBatchSampler(Sampler[List[int]]):
+    """
+    Yields batches of indices with similar lengths, so that less padding is added in `collate_fn`.
+    Indices are shuffled, split into pools of `batch_size * pool_batches`, and each pool is sorted by length
+    before being cut into batches. Batches are then shuffled, so that the order of lengths stays random.
     """
-    padded_wavs = [
-        torch.cat([wav, torch.zeros(target_len - len(wav))])
-        for wav in map(lambda x: x[0], wavs)
-    ]
-    return torch.stack(padded_wavs)
+
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        shuffle: bool = True,
+        pool_batches: int = 50,
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * pool_batches
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        n = len(self.lengths)
+        indices = torch.randperm(n).tolist() if self.shuffle else list(range(n))
+        batches = []
+        for i in range(0, n, self.pool_size):
+            pool = sorted(indices[i : i + self.pool_size], key=self.lengths.__getitem__)
+            batches += [
+                pool[j : j + self.batch_size]
+                for j in range(0, len(pool), self.batch_size)
+            ]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+
+def worker_init_fn(worker_id: int) -> None:
+    """
+    Give each worker its own rng, otherwise all workers forked from the same dataset draw the same numbers.
+    """
+    dataset = torch.utils.data.get_worker_info().dataset
+    while not isinstance(dataset, MixedAudioDataset):
+        dataset = dataset.dataset  # unwrap N2NMixedAudioDataset and Subset
+    # torch already seeds each worker with base_seed + worker_id
+    dataset.rng = np.random.default_rng(torch.initial_seed())
 
 
 MixedAudioDataLoaderOutput = Tuple[Tensor, Tensor]
@@ -217,18 +576,84 @@ def collate_fn(
     pad_length = max(mixed.shape[-1] for mixed, _ in batch)
     pad_length += (alignment - pad_length % alignment) % alignment
 
-    mixed_wavs, clean_wavs = zip(*batch)
-    batch_padded_mixed_wav = pad_seq_n_stack(list(mixed_wavs), pad_length)
-    batch_padded_clean_wav = pad_seq_n_stack(list(clean_wavs), pad_length)
+    # one allocation for both outputs, filled in a single pass over the batch
+    res = torch.zeros(2, len(batch), pad_length, dtype=batch[0][0].dtype)
+    for i, (mixed, clean) in enumerate(batch):
+        res[0, i, : mixed.shape[-1]].copy_(mixed[0])
+        res[1, i, : clean.shape[-1]].copy_(clean[0])
 
-    return (batch_padded_mixed_wav, batch_padded_clean_wav)
+    return (res[0], res[1])
 
 
 class MixedAudioDataLoader(DataLoader):
-    def __init__(self, alignment: int, *args, **kwargs):
+    def __init__(self, alignment: int, *args, bucket: bool = False, **kwargs):
+        if bucket:
+            # batch wavs of similar lengths, see `BucketBatchSampler`
+            kwargs["batch_sampler"] = BucketBatchSampler(
+                get_lengths(kwargs["dataset"]),
+                kwargs.pop("batch_size", 1),
+                kwargs.pop("shuffle", False),
+            )
+        # batches are pinned by the loader in the main process, so that the host to device copy can be non_blocking.
+        # don't pin inside `collate_fn`, cuda can't be initialized in forked workers.
+        kwargs.setdefault("pin_memory", torch.cuda.is_available())
+        kwargs.setdefault("worker_init_fn", worker_init_fn)
+        if kwargs.get("num_workers", 0) > 0:
+            # keep workers, and their `CachedLoader`, alive across epochs
+            kwargs.setdefault("persistent_workers", True)
         super().__init__(collate_fn=partial(collate_fn, alignment), *args, **kwargs)
 
 
+class CudaPrefetcher:
+    """
+    Wraps a `MixedAudioDataLoader`, and copies the next batch to `device` on a side stream
+    while the current batch is being consumed. Falls back to plain iteration on cpu.
+    Only for single device training: batches always go to `device`, and since this is not a DataLoader,
+    Lightning can't inject a DistributedSampler. Pass `devices=1` to the Trainer.
+    """
+
+    def __init__(self, loader: MixedAudioDataLoader, device: torch.device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self) -> Iterator[MixedAudioDataLoaderOutput]:
+        if self.device.type != "cuda":
+            yield from self.loader
+            return
+
+        stream = torch.cuda.Stream(self.device)
+
+        def preload(batch: MixedAudioDataLoaderOutput) -> MixedAudioDataLoaderOutput:
+            with torch.cuda.stream(stream):
+                x, y = batch
+                return (
+                    x.to(self.device, non_blocking=True),
+                    y.to(self.device, non_blocking=True),
+                )
+
+        def ready(batch: MixedAudioDataLoaderOutput) -> MixedAudioDataLoaderOutput:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            for t in batch:
+                # tensors are allocated on `stream`, don't let the allocator reuse them too early
+                t.record_stream(current_stream)
+            return batch
+
+        loader_iter = iter(self.loader)
+        try:
+            next_batch = preload(next(loader_iter))
+        except StopIteration:
+            return
+        for batch in loader_iter:
+            current_batch = ready(next_batch)
+            next_batch = preload(batch)
+            yield current_batch
+        yield ready(next_batch)
+
+
 def plot_melspectrogram(wav, ax, fs=44100, title="Melspectrogram"):
     s = librosa.feature.melspectrogram(y=wav, sr=fs)
     librosa.display.specshow(
@@ -2,40 +2,48 @@ from dataclasses import dataclass
 import lightning
 from DPTNet.models import DPTNet_base
 import torch
+import torch.nn.functional as F
 from dataset import MixedAudioDataLoaderOutput
-from typing import Dict, Any, Callable
+from typing import Dict, Any, Callable, Optional
 from torch.optim.lr_scheduler import ExponentialLR
 from torchmetrics.audio.snr import ScaleInvariantSignalNoiseRatio
 import tqdm
-from settings import FS, infer_block_size
+from settings import FS, infer_block_size, infer_max_batch
 
 
-def rms_loudness(signal: torch.Tensor) -> torch.Tensor:
-    return torch.sqrt(torch.mean(signal**2, dim=-1, keepdim=True))
+def mean_square_loudness(signal: torch.Tensor) -> torch.Tensor:
+    # rms without the sqrt, same minimum when comparing loudness
+    return signal.pow(2).mean(dim=-1, keepdim=True)
 
 
 def loudness_loss(
-    estimated_signal: torch.Tensor, target_signal: torch.Tensor
+    estimated_signal: torch.Tensor, target_signal: torch.Tensor, weight: float = 128
 ) -> torch.Tensor:
-    estimated_loudness = rms_loudness(estimated_signal)
-    target_loudness = rms_loudness(target_signal)
-    return (
-        torch.abs(estimated_loudness - target_loudness) * 128
-    )  # 100 is loudness_loss weight
+    estimated_loudness = mean_square_loudness(estimated_signal)
+    target_loudness = mean_square_loudness(target_signal)
+    # `weight` applies to mean square differences, tune it if this loss is used in training
+    return torch.abs(estimated_loudness - target_loudness) * weight
 
 
 def process_in_block(
     block_size: int,
     wav: torch.Tensor,
     action: Callable[[torch.Tensor], torch.Tensor],
+    max_batch: int = infer_max_batch,
 ) -> torch.Tensor:
+    """
+    Split `wav` (... x T) into blocks of `block_size` (the tail is zero padded),
+    and run `action` on batches of at most `max_batch` blocks.
+    """
     wav_len = wav.shape[-1]
-    res = torch.zeros_like(wav)
-    for i in tqdm.tqdm(range(0, wav_len, block_size)):
-        source = wav[..., i : i + block_size]
-        estimated_source = action(source)
-        res[..., i : i + block_size] += estimated_source
-    return res
+    blocks = F.pad(wav, (0, (-wav_len) % block_size)).reshape(-1, block_size)
+    res = torch.cat(
+        [
+            action(blocks[i : i + max_batch])
+            for i in tqdm.tqdm(range(0, blocks.shape[0], max_batch))
+        ]
+    )
+    return res.reshape(*wav.shape[:-1], -1)[..., :wav_len]
 
 
 @dataclass
@@ -47,6 +55,9 @@ class DPTNetModuleArgs:
     h: int = 4  # number of hidden units in LSTM after multihead attention
     e: int = 256  # #channels before bottleneck
     fs: int = FS
+    # torch.compile mode, None to run eagerly. Only use "reduce-overhead" (cuda graphs) with fixed
+    # pad lengths, as each new T records a new graph
+    compile_mode: Optional[str] = None
 
     @property
     def w(self):
@@ -66,6 +77,15 @@ class N2NDPTNetModule(lightning.LightningModule):
             segment_size=args.k,
             win_len=args.w,
         )
+        if (
+            args.compile_mode is not None
+            and hasattr(torch, "compile")
+            and torch.cuda.is_available()
+        ):
+            # compile forward only, so that state_dict keys stay the same as the eager model
+            self.model.forward = torch.compile(
+                self.model.forward, mode=args.compile_mode
+            )
         self.train_loss = torch.nn.L1Loss()
         self.eval_loss = ScaleInvariantSignalNoiseRatio()
 
@@ -73,7 +93,8 @@ class N2NDPTNetModule(lightning.LightningModule):
         padded_x_hat, padded_y_hat = batch
 
         denoised_x_hat = self.model(padded_x_hat)
-        loss = self.train_loss(denoised_x_hat, padded_y_hat)
+        # compute loss in float32 under mixed precision
+        loss = self.train_loss(denoised_x_hat.float(), padded_y_hat.float())
 
         return loss.squeeze().mean()
 
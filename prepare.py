@@ -0,0 +1,34 @@
+from typing import Tuple
+import click
+from dataset import build_cache, build_manifest
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.argument("clean_folder", nargs=1, type=click.Path(exists=True, file_okay=False))
+@click.argument(
+    "dirty_folders", nargs=-1, type=click.Path(exists=True, file_okay=False)
+)
+@click.option("--out", "-o", type=click.Path(dir_okay=False), required=True)
+def manifest(clean_folder: str, dirty_folders: Tuple[str, ...], out: str):
+    """Save clean and dirty file lists to OUT (.npz)."""
+    build_manifest(clean_folder, list(dirty_folders), out)
+
+
+@main.command()
+@click.argument("clean_folder", nargs=1, type=click.Path(exists=True, file_okay=False))
+@click.argument(
+    "dirty_folders", nargs=-1, type=click.Path(exists=True, file_okay=False)
+)
+@click.option("--out", "-o", type=click.Path(dir_okay=False), required=True)
+def cache(clean_folder: str, dirty_folders: Tuple[str, ...], out: str):
+    """Decode all files once into a float16 cache OUT (.bin) and its OUT.index.npy index."""
+    build_cache(clean_folder, list(dirty_folders), out)
+
+
+if __name__ == "__main__":
+    main()
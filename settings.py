@@ -1,2 +1,6 @@
+import os
+
 FS = 48000
 infer_block_size = 96 * 1000
+infer_max_batch = 8  # number of blocks per forward pass in inference
+cache_size_mb = int(os.environ.get("TSE_CACHE_MB", 2048))
@@ -1,8 +1,9 @@
 import torch
 import torch.utils.data
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 from dataset import (
+    CudaPrefetcher,
     MixedAudioDataset,
     MixedAudioDataLoader,
     N2NMixedAudioDataset,
@@ -24,10 +25,32 @@ class TrainArgs:
     module_args: DPTNetModuleArgs
     exp_name: str
     epochs: int = 10
+    cache_path: Optional[str] = None  # built by `dataset.build_cache`
+    manifest_path: Optional[str] = None  # built by `dataset.build_manifest`
+    cache_warm_fraction: float = 0.0  # see `MixedAudioDataset.warm_cache`
+    precision: Optional[str] = None  # Trainer precision, None to pick by hardware
+
+
+def get_precision(args: TrainArgs) -> str:
+    if args.precision is not None:
+        return args.precision
+    # bf16 autocast runs linear, conv and LSTM on tensor cores on Ampere+
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return "bf16-mixed"
+    return "32-true"
+
+
+def build_dataset(args: TrainArgs) -> MixedAudioDataset:
+    if args.manifest_path is not None:
+        dataset = MixedAudioDataset.from_manifest(args.manifest_path, args.cache_path)
+    else:
+        dataset = MixedAudioDataset(args.clean_dir, args.dirty_dirs, args.cache_path)
+    dataset.warm_cache(args.cache_warm_fraction)
+    return dataset
 
 
 def train(args: TrainArgs):
-    dataset = N2NMixedAudioDataset(MixedAudioDataset(args.clean_dir, args.dirty_dirs))
+    dataset = N2NMixedAudioDataset(build_dataset(args))
 
     loader = MixedAudioDataLoader(
         alignment=args.module_args.w
@@ -35,6 +58,7 @@ def train(args: TrainArgs):
         dataset=dataset,
         batch_size=args.batch_size,
         shuffle=True,
+        bucket=True,
     )
 
     model = N2NDPTNetModule(args.module_args)
@@ -47,12 +71,16 @@ def train(args: TrainArgs):
         logger=TensorBoardLogger("tb_logs", name=args.exp_name),
         callbacks=[checkpoint_callback],
         max_epochs=args.epochs,
+        precision=get_precision(args),
+        # `CudaPrefetcher` moves batches to `device`, so train on that single device only
+        accelerator=device.type,
+        devices=1,
     )
-    trainer.fit(model, loader)
+    trainer.fit(model, CudaPrefetcher(loader, device))
 
 
 def train_and_eval(args: TrainArgs):
-    full_dataset = MixedAudioDataset(args.clean_dir, args.dirty_dirs)
+    full_dataset = build_dataset(args)
 
     train_size = int(0.8 * len(full_dataset))
     eval_size = len(full_dataset) - train_size
@@ -66,6 +94,7 @@ def train_and_eval(args: TrainArgs):
         dataset=n2n_train_dataset,
         batch_size=args.batch_size,
         shuffle=True,
+        bucket=True,
     )
     eval_loader = MixedAudioDataLoader(
         alignment=args.module_args.w
@@ -86,8 +115,14 @@ def train_and_eval(args: TrainArgs):
         logger=TensorBoardLogger("tb_logs", name=args.exp_name),
         callbacks=[checkpoint_callback],
         max_epochs=args.epochs,
+        precision=get_precision(args),
+        # `CudaPrefetcher` moves batches to `device`, so train on that single device only
+        accelerator=device.type,
+        devices=1,
+    )
+    trainer.fit(
+        model, CudaPrefetcher(train_loader, device), CudaPrefetcher(eval_loader, device)
     )
-    trainer.fit(model, train_loader, eval_loader)
 
 
 if __name__ == "__main__":